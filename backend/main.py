@@ -1,18 +1,22 @@
 import asyncio
 import base64
+import hashlib
 import io
 import json
 import os
-import time
+import sys
 import traceback
 import yaml
-from contextlib import asynccontextmanager
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 from uuid import uuid4
 
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
@@ -34,6 +38,7 @@ from models import (
     ReferenceSummaryResponse,
     LearningSummarizeRequest,
     LearningSummaryResponse,
+    pdf_info_list_adapter,
 )
 from storage import pdf_storage, jobs_storage
 
@@ -44,37 +49,179 @@ load_dotenv(Path(__file__).parent.parent / ".env")
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
 # Load prompts from YAML (in same directory as main.py)
+# Prefer the libyaml-backed loader when PyYAML was built with it
+YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 prompts_path = Path(__file__).parent / "prompts.yaml"
 with open(prompts_path, "r") as f:
-    prompts = yaml.safe_load(f)
+    prompts = yaml.load(f, Loader=YAMLLoader)
 
 CHAT_SYSTEM_PROMPT = prompts["chat"]["system_prompt"]
 FORMULA_SYSTEM_PROMPT = prompts["formula"]["system_prompt"]
 FIGURE_SYSTEM_PROMPT = prompts["figure"]["system_prompt"]
 LEARNING_PLAN_PROMPT_TEMPLATE = prompts["learning_plan"]["prompt_template"]
+CHAT_CONTEXT_SUFFIX = "\n\nI'll be asking questions about this context. Please help me understand it."
+CHAT_GREETING = "I'll help you understand this context. What would you like to know?"
+CHAT_GREETING_MESSAGE = {"role": "model", "parts": [{"text": CHAT_GREETING}]}
 EQUATION_ANNOTATION_SYSTEM_PROMPT = (
     "Create an image that repreoeduces the equation image exactlty but with annotations "
     "in handwritten ink that explain the equation according the question asked"
 )
 
+# Width/height ratio thresholds for equation annotation images: a ratio above
+# ASPECT_RATIO_THRESHOLDS[i] (and not above the next one) maps to ASPECT_RATIO_LABELS[i + 1].
+# Use smaller sizes for faster generation - frontend will scale up
+ASPECT_RATIO_THRESHOLDS = (0.6, 0.9, 1.5, 2.2)
+ASPECT_RATIO_LABELS = (
+    "9:16",
+    "3:4",   # Simplified for medium tall
+    "1:1",
+    "4:3",   # Simplified to 4:3 for medium wide
+    "16:9",  # Use 16:9 instead of 21:9 for faster generation
+)
+
+# Size of the default thread pool used by asyncio.to_thread
+DEFAULT_EXECUTOR_WORKERS = 32
+
 # Note: Jobs are now persisted in jobs_storage (from storage.py)
 # No need for in-memory jobs dictionary
 
 
-async def iterate_in_thread(sync_iterable):
-    """Convert a sync iterator to async by running each next() in thread pool."""
-    def get_next(iterator):
+# Payloads above this size are base64 encoded/decoded in a worker thread
+CODEC_THREAD_THRESHOLD = 256 * 1024
+
+
+async def run_codec(codec, data):
+    """Run a bytes codec such as base64, off the event loop for large payloads."""
+    if len(data) > CODEC_THREAD_THRESHOLD:
+        return await asyncio.to_thread(codec, data)
+    return codec(data)
+
+
+# Max SSE frames buffered between a Gemini stream and a slow client
+SSE_QUEUE_SIZE = 64
+# Frames already waiting in the queue are joined into writes of up to this size
+SSE_FLUSH_BYTES = 4096
+_STREAM_END = object()
+
+
+async def bounded_batches(stream, maxsize: int = SSE_QUEUE_SIZE):
+    """
+    Read an async stream in a background task through a bounded queue.
+    When the client falls behind the queue fills and the producer waits,
+    so no more than maxsize items are held per response. Each batch holds
+    every item that was waiting when the consumer woke up.
+    """
+    queue = asyncio.Queue(maxsize=maxsize)
+
+    async def produce():
         try:
-            return next(iterator)
-        except StopIteration:
-            return None
+            async for item in stream:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+            return
+        finally:
+            await close_stream(stream)
+        await queue.put(_STREAM_END)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            batch = []
+            item = await queue.get()
+            while item is not _STREAM_END and not isinstance(item, Exception):
+                batch.append(item)
+                if queue.empty():
+                    break
+                item = queue.get_nowait()
+            if batch:
+                yield batch
+            if item is _STREAM_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+
+async def coalesce_frames(events):
+    """Send SSE frames that are ready at the same time as one write."""
+    buffer = bytearray()
+    async with aclosing(bounded_batches(events)) as batches:
+        async for frames in batches:
+            for frame in frames:
+                buffer += frame.encode()
+                if len(buffer) >= SSE_FLUSH_BYTES:
+                    yield bytes(buffer)
+                    buffer.clear()
+            if buffer:
+                yield bytes(buffer)
+                buffer.clear()
+
+
+async def close_stream(response):
+    """Stop a Gemini response stream so no further chunks are fetched."""
+    aclose = getattr(response, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",  # disable proxy (nginx) response buffering
+}
+
+
+# Compact encoder reused for every SSE frame (no per-call option handling)
+_encode_json = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(",", ":")).encode
+
+
+def sse_event(payload: dict) -> str:
+    """Format a payload as a single SSE data frame."""
+    return f"data: {_encode_json(payload)}\n\n"
+
+
+SSE_DONE = sse_event({"done": True})
+
+
+def sse_response(events) -> StreamingResponse:
+    """Wrap an async generator of SSE frames in a streaming response."""
+    return StreamingResponse(coalesce_frames(events), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# In-memory LRU of completed formula explanations, keyed by prompt digest
+FORMULA_CACHE_SIZE = 512
+formula_cache: OrderedDict[bytes, tuple[str, ...]] = OrderedDict()
+
+
+def formula_cache_key(prompt: str) -> bytes:
+    """Digest of a formula prompt, used as the cache key."""
+    return hashlib.blake2b(prompt.encode(), digest_size=16).digest()
 
-    iterator = iter(sync_iterable)
-    while True:
-        chunk = await asyncio.to_thread(get_next, iterator)
-        if chunk is None:
-            break
-        yield chunk
+
+def formula_cache_get(key: bytes) -> Optional[tuple[str, ...]]:
+    """Return cached text chunks for a prompt and mark them recently used."""
+    chunks = formula_cache.get(key)
+    if chunks is not None:
+        formula_cache.move_to_end(key)
+    return chunks
+
+
+def formula_cache_put(key: bytes, chunks: list[str]):
+    """Store the text chunks of a completed explanation, evicting the oldest."""
+    formula_cache[key] = tuple(chunks)
+    formula_cache.move_to_end(key)
+    if len(formula_cache) > FORMULA_CACHE_SIZE:
+        formula_cache.popitem(last=False)
+
+
+async def replay_chunks(chunks):
+    """Stream previously generated text chunks as SSE frames."""
+    for text in chunks:
+        yield sse_event({"text": text})
+    yield SSE_DONE
 
 
 # Lifespan context manager
@@ -82,9 +229,15 @@ async def iterate_in_thread(sync_iterable):
 async def lifespan(app: FastAPI):
     # Startup
     print("Starting Rabbit Hole API...")
+    # Blocking Gemini calls (uploads, deep research jobs) each hold a worker thread
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DEFAULT_EXECUTOR_WORKERS)
+    )
     yield
     # Shutdown
     print("Shutting down Rabbit Hole API...")
+    pdf_storage.close()
+    jobs_storage.close()
 
 
 # Initialize FastAPI app
@@ -130,36 +283,31 @@ async def upload_pdf(
 
     try:
         # Create file search store for this PDF
-        file_search_store = client.file_search_stores.create(
+        file_search_store = await asyncio.to_thread(
+            client.file_search_stores.create,
             config={'display_name': display_name or file.filename}
         )
 
-        # Save uploaded file temporarily
-        temp_dir = Path("/tmp/rabbit-hole")
-        temp_dir.mkdir(exist_ok=True)
-        temp_path = temp_dir / file.filename
-
-        with open(temp_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-
-        # Upload to file search store
-        operation = client.file_search_stores.upload_to_file_search_store(
-            file=str(temp_path),
+        # Upload to file search store straight from the spooled upload, which the
+        # SDK reads in chunks (no temp copy, no full read into memory)
+        await file.seek(0)
+        operation = await asyncio.to_thread(
+            client.file_search_stores.upload_to_file_search_store,
+            file=file.file,
             file_search_store_name=file_search_store.name,
-            config={'display_name': display_name or file.filename}
+            config={
+                'display_name': display_name or file.filename,
+                'mime_type': 'application/pdf',
+            }
         )
 
         # Poll for completion (with timeout)
         max_wait = 30  # seconds
         elapsed = 0
         while not operation.done and elapsed < max_wait:
-            time.sleep(2)
+            await asyncio.sleep(2)
             elapsed += 2
-            operation = client.operations.get(operation)
-
-        # Clean up temp file
-        temp_path.unlink(missing_ok=True)
+            operation = await asyncio.to_thread(client.operations.get, operation)
 
         # Prepare response data
         upload_time = datetime.now().isoformat()
@@ -204,7 +352,7 @@ async def list_pdfs():
     Get list of all uploaded PDFs with their metadata.
     """
     all_pdfs = pdf_storage.all()
-    pdf_list = [PDFInfo(**pdf_data) for pdf_data in all_pdfs.values()]
+    pdf_list = pdf_info_list_adapter.validate_python(list(all_pdfs.values()))
 
     return PDFListResponse(
         pdfs=pdf_list,
@@ -227,7 +375,7 @@ async def get_pdf_info(filename: str):
 
 
 @app.post("/api/chat/stream")
-async def chat_stream(request: ChatRequest):
+async def chat_stream(request: ChatRequest, http_request: Request):
     """
     Stream AI response for highlighted text questions.
     Uses SSE (Server-Sent Events) for real-time streaming.
@@ -238,29 +386,24 @@ async def chat_stream(request: ChatRequest):
         raise HTTPException(status_code=400, detail="Both question and context are required")
 
     async def event_generator():
+        response = None
         try:
             # Build conversation history
             page_ref = f" (from page {request.page})" if request.page else ""
 
-            # Format the contents for Gemini
-            contents = []
-
-            # Add initial context as first user message
-            context_message = f"""Context{page_ref}:
-{request.context}
-
-I'll be asking questions about this context. Please help me understand it."""
-            contents.append({"role": "user", "parts": [{"text": context_message}]})
-            contents.append({"role": "model", "parts": [{"text": "I'll help you understand this context. What would you like to know?"}]})
-
-            # Add conversation history
-            if request.history:
-                for msg in request.history:
-                    role = "user" if msg.role == "user" else "model"
-                    contents.append({"role": role, "parts": [{"text": msg.content}]})
+            # Initial context as first user message, followed by the canned greeting
+            context_message = f"Context{page_ref}:\n{request.context}{CHAT_CONTEXT_SUFFIX}"
 
-            # Add the current question
-            contents.append({"role": "user", "parts": [{"text": request.question}]})
+            # Format the contents for Gemini: context, greeting, history, current question
+            contents = [
+                {"role": "user", "parts": [{"text": context_message}]},
+                CHAT_GREETING_MESSAGE,
+                *(
+                    {"role": "user" if msg.role == "user" else "model", "parts": [{"text": msg.content}]}
+                    for msg in request.history or ()
+                ),
+                {"role": "user", "parts": [{"text": request.question}]},
+            ]
 
             # Configure tools if file_search_store_id is provided
             tools = []
@@ -281,35 +424,31 @@ I'll be asking questions about this context. Please help me understand it."""
                 config.tools = tools
 
             # Stream the response (use async iterator to avoid blocking event loop)
-            response = client.models.generate_content_stream(
+            response = await client.aio.models.generate_content_stream(
                 model="gemini-3-flash-preview",
                 contents=contents,
                 config=config
             )
 
-            async for chunk in iterate_in_thread(response):
+            async for chunk in response:
                 if chunk.text:
-                    data = json.dumps({"text": chunk.text})
-                    yield f"data: {data}\n\n"
+                    yield sse_event({"text": chunk.text})
+                if await http_request.is_disconnected():
+                    return
 
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield SSE_DONE
 
         except Exception as e:
-            error_data = json.dumps({"error": str(e)})
-            yield f"data: {error_data}\n\n"
-
-    return StreamingResponse(
-        event_generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
-    )
+            yield sse_event({"error": str(e)})
+        finally:
+            await close_stream(response)
+
+    return sse_response(event_generator())
 
 
 @app.get("/api/chat/formula")
 async def formula_explain(
+    http_request: Request,
     formula: str,
     context: Optional[str] = None,
     page: Optional[int] = None
@@ -321,15 +460,24 @@ async def formula_explain(
     if not formula:
         raise HTTPException(status_code=400, detail="Formula is required")
 
+    # Build the user prompt
+    page_ref = f" (from page {page})" if page else ""
+    context_part = f"\n\nContext{page_ref}:\n{context}" if context else ""
+    user_prompt = f"""Formula: {formula}{context_part}"""
+
+    # Replay identical questions from the cache instead of calling Gemini again
+    cache_key = formula_cache_key(user_prompt)
+    cached = formula_cache_get(cache_key)
+    if cached is not None:
+        return sse_response(replay_chunks(cached))
+
     async def event_generator():
+        response = None
         try:
-            # Build the user prompt
-            page_ref = f" (from page {page})" if page else ""
-            context_part = f"\n\nContext{page_ref}:\n{context}" if context else ""
-            user_prompt = f"""Formula: {formula}{context_part}"""
+            chunks = []
 
             # Stream the response
-            response = client.models.generate_content_stream(
+            response = await client.aio.models.generate_content_stream(
                 model="gemini-3-flash-preview",
                 contents=user_prompt,
                 config=types.GenerateContentConfig(
@@ -338,29 +486,28 @@ async def formula_explain(
                 )
             )
 
-            for chunk in response:
+            async for chunk in response:
                 if chunk.text:
-                    data = json.dumps({"text": chunk.text})
-                    yield f"data: {data}\n\n"
+                    chunks.append(chunk.text)
+                    yield sse_event({"text": chunk.text})
+                if await http_request.is_disconnected():
+                    return
 
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            # Don't cache empty answers (e.g. safety-blocked or no candidates)
+            if chunks:
+                formula_cache_put(cache_key, chunks)
+            yield SSE_DONE
 
         except Exception as e:
-            error_data = json.dumps({"error": str(e)})
-            yield f"data: {error_data}\n\n"
-
-    return StreamingResponse(
-        event_generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
-    )
+            yield sse_event({"error": str(e)})
+        finally:
+            await close_stream(response)
+
+    return sse_response(event_generator())
 
 
 @app.post("/api/chat/figure")
-async def figure_explain(request: FigureRequest):
+async def figure_explain(request: FigureRequest, http_request: Request):
     """
     Analyze and explain figures/diagrams from PDF.
     Streams response via SSE.
@@ -369,6 +516,7 @@ async def figure_explain(request: FigureRequest):
         raise HTTPException(status_code=400, detail="image_base64 is required")
 
     async def event_generator():
+        response = None
         try:
             # Build the user prompt
             page_ref = f" (from page {request.page})" if request.page else ""
@@ -386,7 +534,7 @@ async def figure_explain(request: FigureRequest):
             ]
 
             # Stream the response
-            response = client.models.generate_content_stream(
+            response = await client.aio.models.generate_content_stream(
                 model="gemini-3-flash-preview",
                 contents=contents,
                 config=types.GenerateContentConfig(
@@ -395,25 +543,20 @@ async def figure_explain(request: FigureRequest):
                 )
             )
 
-            for chunk in response:
+            async for chunk in response:
                 if chunk.text:
-                    data = json.dumps({"text": chunk.text})
-                    yield f"data: {data}\n\n"
+                    yield sse_event({"text": chunk.text})
+                if await http_request.is_disconnected():
+                    return
 
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield SSE_DONE
 
         except Exception as e:
-            error_data = json.dumps({"error": str(e)})
-            yield f"data: {error_data}\n\n"
-
-    return StreamingResponse(
-        event_generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
-    )
+            yield sse_event({"error": str(e)})
+        finally:
+            await close_stream(response)
+
+    return sse_response(event_generator())
 
 
 @app.post("/api/reference/summarize", response_model=ReferenceSummaryResponse)
@@ -547,7 +690,7 @@ Write in a friendly, encouraging tone. Be specific about the paper content they
 
 
 @app.post("/api/chat/equation")
-async def equation_explain(request: EquationRequest):
+async def equation_explain(request: EquationRequest, http_request: Request):
     """
     Analyze and explain equations from PDF using image.
     Streams response via SSE.
@@ -556,6 +699,7 @@ async def equation_explain(request: EquationRequest):
         raise HTTPException(status_code=400, detail="image_base64 is required")
 
     async def event_generator():
+        response = None
         try:
             # Build the user prompt
             page_ref = f" (from page {request.page})" if request.page else ""
@@ -573,7 +717,7 @@ async def equation_explain(request: EquationRequest):
             ]
 
             # Stream the response using FORMULA_SYSTEM_PROMPT (same as text formulas)
-            response = client.models.generate_content_stream(
+            response = await client.aio.models.generate_content_stream(
                 model="gemini-3-flash-preview",
                 contents=contents,
                 config=types.GenerateContentConfig(
@@ -582,25 +726,20 @@ async def equation_explain(request: EquationRequest):
                 )
             )
 
-            for chunk in response:
+            async for chunk in response:
                 if chunk.text:
-                    data = json.dumps({"text": chunk.text})
-                    yield f"data: {data}\n\n"
+                    yield sse_event({"text": chunk.text})
+                if await http_request.is_disconnected():
+                    return
 
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield SSE_DONE
 
         except Exception as e:
-            error_data = json.dumps({"error": str(e)})
-            yield f"data: {error_data}\n\n"
-
-    return StreamingResponse(
-        event_generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
-    )
+            yield sse_event({"error": str(e)})
+        finally:
+            await close_stream(response)
+
+    return sse_response(event_generator())
 
 
 @app.post("/api/equation/annotate", response_model=EquationAnnotationResponse)
@@ -615,24 +754,12 @@ async def equation_annotate(request: EquationAnnotationRequest):
 
     try:
         try:
-            image_bytes = base64.b64decode(request.image_base64)
+            image_bytes = await run_codec(base64.b64decode, request.image_base64)
         except Exception:
             image_bytes = request.image_base64.encode() if isinstance(request.image_base64, str) else request.image_base64
 
         # Convert aspect ratio to Gemini format (closest match)
-        # Use smaller sizes for faster generation - frontend will scale up
-        aspect_ratio_str = "1:1"  # default
-        ratio = request.aspect_ratio
-        if ratio > 2.2:
-            aspect_ratio_str = "16:9"  # Use 16:9 instead of 21:9 for faster generation
-        elif ratio > 1.5:
-            aspect_ratio_str = "4:3"   # Simplified to 4:3 for medium wide
-        elif ratio > 0.9:
-            aspect_ratio_str = "1:1"
-        elif ratio > 0.6:
-            aspect_ratio_str = "3:4"   # Simplified for medium tall
-        else:
-            aspect_ratio_str = "9:16"
+        aspect_ratio_str = ASPECT_RATIO_LABELS[bisect_left(ASPECT_RATIO_THRESHOLDS, request.aspect_ratio)]
 
         contents = [
             types.Part.from_bytes(
@@ -681,7 +808,7 @@ async def equation_annotate(request: EquationAnnotationRequest):
                     print(f"Part {i} has inline_data")
                     image_data = part.inline_data.data
                     if image_data:
-                        image_base64 = base64.b64encode(image_data).decode("utf-8")
+                        image_base64 = (await run_codec(base64.b64encode, image_data)).decode("utf-8")
                         print("Got image from inline_data")
                         break
 
@@ -692,7 +819,7 @@ async def equation_annotate(request: EquationAnnotationRequest):
                     if image:
                         buffer = io.BytesIO()
                         image.save(buffer, format="PNG")
-                        image_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+                        image_base64 = (await run_codec(base64.b64encode, buffer.getvalue())).decode("utf-8")
                         print("Got image from as_image")
                         break
 
@@ -781,7 +908,8 @@ async def process_learning_plan(job_id: str, request: LearningPlanRequest):
         job_data["progress"] = "Running deep research..."
         jobs_storage.set(job_id, job_data)
 
-        response = client.models.generate_content(
+        response = await asyncio.to_thread(
+            client.models.generate_content,
             model="gemini-3-flash-preview",
             contents=prompt,
             config=types.GenerateContentConfig(
@@ -815,5 +943,8 @@ if __name__ == "__main__":
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        reload=True,
+        # uvloop/httptools come with uvicorn[standard]; uvloop has no Windows build
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
     )
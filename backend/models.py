@@ -1,5 +1,5 @@
 from typing import Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 
 
 class PDFUploadResponse(BaseModel):
@@ -21,6 +21,10 @@ class PDFInfo(BaseModel):
     upload_time: str
 
 
+# Validates a whole list of stored PDF records in a single pydantic-core call
+pdf_info_list_adapter = TypeAdapter(list[PDFInfo])
+
+
 class PDFListResponse(BaseModel):
     pdfs: list[PDFInfo]
     total: int
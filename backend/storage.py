@@ -1,50 +1,79 @@
 import json
+import sqlite3
+import threading
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 from datetime import datetime
 
+# Compact encoder for stored values
+_encode_json = json.JSONEncoder(separators=(",", ":"), default=str).encode
 
-class JSONStorage:
-    """Simple JSON-based storage for persistence"""
 
-    def __init__(self, filepath: str):
+class SQLiteStorage:
+    """Key-value storage backed by SQLite in WAL mode.
+
+    Exposes a get/set/delete/all interface; values are stored as JSON text.
+    If legacy_json is given and the table is empty, its contents are imported.
+    """
+
+    def __init__(self, filepath: str, legacy_json: Optional[str] = None):
         self.filepath = Path(filepath)
         self.filepath.parent.mkdir(parents=True, exist_ok=True)
-        self._ensure_file_exists()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+        if legacy_json:
+            self._import_json(Path(legacy_json))
 
-    def _ensure_file_exists(self):
-        """Create file with empty dict if it doesn't exist"""
-        if not self.filepath.exists():
-            self.filepath.write_text(json.dumps({}, indent=2))
+    def _import_json(self, path: Path):
+        """
+        Import data from an old JSON storage file into an empty table.
+        The file is renamed to *.imported afterwards so it is only imported once.
+        """
+        if not path.exists():
+            return
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM kv LIMIT 1").fetchone():
+                return
+        try:
+            data = json.loads(path.read_text())
+        except json.JSONDecodeError:
+            return
+        self.write(data)
+        path.rename(path.with_name(path.name + ".imported"))
 
     def read(self) -> Dict[str, Any]:
-        """Read data from JSON file"""
-        try:
-            return json.loads(self.filepath.read_text())
-        except (json.JSONDecodeError, FileNotFoundError):
-            return {}
+        """Read all data from the database"""
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM kv").fetchall()
+        return {key: json.loads(value) for key, value in rows}
 
     def write(self, data: Dict[str, Any]):
-        """Write data to JSON file"""
-        self.filepath.write_text(json.dumps(data, indent=2, default=str))
+        """Replace all data in the database"""
+        rows = [(key, _encode_json(value)) for key, value in data.items()]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM kv")
+            self._conn.executemany("INSERT INTO kv (key, value) VALUES (?, ?)", rows)
 
     def get(self, key: str, default=None) -> Any:
         """Get a specific key from storage"""
-        data = self.read()
-        return data.get(key, default)
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
 
     def set(self, key: str, value: Any):
         """Set a specific key in storage"""
-        data = self.read()
-        data[key] = value
-        self.write(data)
+        encoded = _encode_json(value)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, encoded))
 
     def delete(self, key: str):
         """Delete a specific key from storage"""
-        data = self.read()
-        if key in data:
-            del data[key]
-            self.write(data)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM kv WHERE key = ?", (key,))
 
     def all(self) -> Dict[str, Any]:
         """Get all data"""
@@ -54,8 +83,13 @@ class JSONStorage:
         """Clear all data"""
         self.write({})
 
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
+
 
 # Initialize storage instances (relative to storage.py location in backend/)
 _storage_dir = Path(__file__).parent / "data"
-pdf_storage = JSONStorage(str(_storage_dir / "pdfs.json"))
-jobs_storage = JSONStorage(str(_storage_dir / "jobs.json"))
\ No newline at end of file
+pdf_storage = SQLiteStorage(str(_storage_dir / "pdfs.db"), legacy_json=str(_storage_dir / "pdfs.json"))
+jobs_storage = SQLiteStorage(str(_storage_dir / "jobs.db"), legacy_json=str(_storage_dir / "jobs.json"))
\ No newline at end of file